@@ -18,12 +18,47 @@ Options:
 """
 
 import argparse
+import csv
+import heapq
+import mmap
+import operator
+import os
+import re
+import stat
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, Set, List, Tuple
+from typing import Dict, FrozenSet, List, Tuple
 
+# Block size for streaming a full FASTA that cannot be memory-mapped
+FASTA_CHUNK_SIZE = 4 * 1024 * 1024
 
-def parse_protein_matrix(matrix_file: Path, top_n: int = None, min_peptides: int = 2) -> Set[str]:
+# Full FASTA files at least this large are scanned by parallel workers; the
+# serial scan covers ~0.7 GB/s and can stop early, so smaller files gain nothing
+PARALLEL_MIN_SIZE = 1024 * 1024 * 1024
+
+# Number of proteins rendered before each write to the minimal FASTA
+WRITE_BATCH_SIZE = 1000
+
+# Protein ID from a FASTA header: the second '|' field (sp|P12345|..., tr|...)
+# or, for simple headers, the first word
+_FASTA_ID_PATTERN = rb'>(?:[^|\n]*\|[^\S\n]*([^|\s]+)|[^\S\n]*(\S+))'
+FASTA_ID_RE = re.compile(_FASTA_ID_PATTERN)
+
+# Any later header, matched together with the newline ending the previous
+# record; the literal prefix lets the regex engine skip quickly over sequences
+FASTA_HEADER_RE = re.compile(rb'\n' + _FASTA_ID_PATTERN)
+
+
+def _to_float(value: str) -> float:
+    """Parse an intensity cell, treating empty or unparseable values as 0."""
+    try:
+        return float(value)
+    except ValueError:
+        return 0.0
+
+
+def parse_protein_matrix(matrix_file: Path, top_n: int = None, min_peptides: int = 2) -> FrozenSet[bytes]:
     """
     Extract protein IDs from DIA-NN protein matrix.
 
@@ -33,14 +68,19 @@ def parse_protein_matrix(matrix_file: Path, top_n: int = None, min_peptides: int
         min_peptides: Minimum number of peptides to include protein
 
     Returns:
-        Set of protein IDs to include in FASTA
+        Set of protein IDs (as bytes, matching raw FASTA headers) to include
     """
-    protein_data = []
+    protein_groups = []  # All passing groups when top_n is not set
+    top_heap = []  # Min-heap of the top_n most abundant groups otherwise
+    n_loaded = 0
 
     print(f"Reading protein matrix: {matrix_file}")
 
-    with open(matrix_file, 'r') as f:
-        header = f.readline().strip().split('\t')
+    with open(matrix_file, 'r', newline='') as f:
+        # csv.reader splits rows in C and keeps trailing empty sample columns;
+        # the matrix is plain TSV, so quote characters are ordinary text
+        reader = csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE)
+        header = next(reader)
 
         # Find column indices
         protein_col = header.index('Protein.Group')
@@ -54,99 +94,237 @@ def parse_protein_matrix(matrix_file: Path, top_n: int = None, min_peptides: int
             sys.exit(1)
 
         print(f"Found {len(intensity_cols)} sample columns")
+        n_samples = len(intensity_cols)
+
+        # Pull N.Sequences and all sample values out of a row in one C call
+        get_values = operator.itemgetter(n_seq_col, *intensity_cols)
+
+        n_fields = len(header)
 
-        for line in f:
-            fields = line.strip().split('\t')
-            protein_id = fields[protein_col]
-            n_sequences = int(fields[n_seq_col])
+        for fields in reader:
+            if len(fields) < n_fields:
+                # Trailing empty sample cells may have been trimmed; count them as 0
+                fields += [''] * (n_fields - len(fields))
+            n_seq, *intensities = get_values(fields)
+            n_sequences = int(n_seq)
 
             # Skip proteins with too few peptides
             if n_sequences < min_peptides:
                 continue
 
-            # Calculate mean intensity across samples
-            intensities = []
-            for col_idx in intensity_cols:
-                try:
-                    val = float(fields[col_idx]) if fields[col_idx] else 0
-                    intensities.append(val)
-                except (ValueError, IndexError):
-                    intensities.append(0)
-
-            mean_intensity = sum(intensities) / len(intensities) if intensities else 0
-
-            protein_data.append((protein_id, mean_intensity, n_sequences))
+            n_loaded += 1
+            if not top_n:
+                protein_groups.append(fields[protein_col])
+                continue
 
-    print(f"Loaded {len(protein_data)} proteins (≥{min_peptides} peptides)")
+            # Calculate mean intensity across samples (missing values count as 0)
+            try:
+                total = sum(map(float, filter(None, intensities)))
+            except ValueError:
+                # Rare unparseable cells (e.g. 'NA') also count as 0
+                total = sum(map(_to_float, intensities))
+            mean_intensity = total / n_samples
+
+            # Keep only the top_n most abundant proteins seen so far; -n_loaded
+            # makes the earlier row win ties, as a stable sort would
+            item = (mean_intensity, -n_loaded, fields[protein_col])
+            if len(top_heap) < top_n:
+                heapq.heappush(top_heap, item)
+            else:
+                heapq.heappushpop(top_heap, item)
 
-    # Sort by abundance
-    protein_data.sort(key=lambda x: x[1], reverse=True)
+    print(f"Loaded {n_loaded} proteins (≥{min_peptides} peptides)")
 
     # Select proteins
-    if top_n and top_n < len(protein_data):
-        selected = protein_data[:top_n]
+    if top_n:
+        protein_groups = [protein_group for _, _, protein_group in top_heap]
+    if top_n and top_n < n_loaded:
         print(f"Selected top {top_n} most abundant proteins")
     else:
-        selected = protein_data
-        print(f"Selected all {len(selected)} proteins")
+        print(f"Selected all {n_loaded} proteins")
 
     # Extract protein IDs (handle semicolon-separated groups)
-    protein_ids = set()
-    for protein_group, _, _ in selected:
+    # Kept as bytes so FASTA headers can be matched without decoding
+    protein_ids = frozenset(
+        protein_id.strip().encode()
+        for protein_group in protein_groups
         # Protein groups may be semicolon-separated
-        for protein_id in protein_group.split(';'):
-            protein_ids.add(protein_id.strip())
+        for protein_id in protein_group.split(';')
+    )
 
     print(f"Total unique protein IDs: {len(protein_ids)}")
     return protein_ids
 
 
-def extract_fasta_entries(full_fasta: Path, protein_ids: Set[str]) -> Dict[str, str]:
+def _add_fasta_record(buf, start: int, end: int, protein_id: bytes,
+                      entries: Dict[bytes, Tuple[bytes, bytes]]):
+    """Store the FASTA record whose header begins at buf[start], bounded by end."""
+    header_end = buf.find(b'\n', start, end)
+    if header_end == -1:
+        header_end = end
+    record_end = buf.find(b'\n>', header_end, end)
+    if record_end == -1:
+        record_end = end
+
+    # Sequence lines are joined by dropping all line breaks in one pass
+    entries[protein_id] = (buf[start:header_end].rstrip(),
+                           buf[header_end + 1:record_end].translate(None, b'\r\n'))
+
+
+def _scan_fasta_range(buf, start: int, end: int, protein_ids: FrozenSet[bytes],
+                      entries: Dict[bytes, Tuple[bytes, bytes]]):
+    """
+    Add wanted records found in buf[start:end], which must begin at a record.
+
+    Headers are located and their IDs captured by a single regex scan in C,
+    so the Python loop runs once per header and only does a set lookup.
+    Sequences are sliced out for wanted proteins only, and the scan stops as
+    soon as every requested protein has been found.
+    """
+    n_wanted = len(protein_ids)
+    if start == 0:
+        # The first record in the file has no newline before its '>'
+        m = FASTA_ID_RE.match(buf, 0, end)
+        if m and (protein_id := m.group(1) or m.group(2)) in protein_ids:
+            _add_fasta_record(buf, 0, end, protein_id, entries)
+    else:
+        start -= 1  # Include the newline that precedes the first header
+
+    for m in FASTA_HEADER_RE.finditer(buf, start, end):
+        if len(entries) >= n_wanted:
+            break
+        protein_id = m.group(1) or m.group(2)
+        if protein_id in protein_ids:
+            _add_fasta_record(buf, m.start() + 1, end, protein_id, entries)
+
+
+def _scan_fasta_stream(fd: int, protein_ids: FrozenSet[bytes],
+                       entries: Dict[bytes, Tuple[bytes, bytes]]):
+    """
+    Add wanted records from an open FASTA that cannot be memory-mapped.
+
+    The file descriptor is read in raw FASTA_CHUNK_SIZE blocks; complete
+    records in each block go through _scan_fasta_range and the incomplete
+    last record is carried over to the next block. The caller owns fd.
+    """
+    n_wanted = len(protein_ids)
+    tail = b''
+
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass  # Only a hint; pipes and FIFOs reject it
+    while len(entries) < n_wanted and (chunk := os.read(fd, FASTA_CHUNK_SIZE)):
+        buf = tail + chunk
+        # The carried-over tail holds no boundary, so only rescan its last byte
+        cut = buf.rfind(b'\n>', max(len(tail) - 1, 0))
+        if cut == -1:
+            tail = buf
+            continue
+        _scan_fasta_range(buf, 0, cut, protein_ids, entries)
+        tail = buf[cut + 1:]
+
+    # Don't forget last entry (unless the scan already stopped early)
+    if len(entries) < n_wanted:
+        _scan_fasta_range(tail, 0, len(tail), protein_ids, entries)
+
+
+def _fasta_split_points(buf, n_chunks: int) -> List[int]:
+    """
+    Split buf into about n_chunks byte ranges that each start at a record.
+
+    Returns:
+        Sorted offsets [0, ..., len(buf)] delimiting the ranges
+    """
+    size = len(buf)
+    bounds = [0]
+    for k in range(1, n_chunks):
+        split = buf.find(b'\n>', k * size // n_chunks)
+        if split == -1:
+            break
+        if split + 1 > bounds[-1]:
+            bounds.append(split + 1)
+    bounds.append(size)
+    return bounds
+
+
+def _scan_fasta_file_range(full_fasta: Path, start: int, end: int,
+                           protein_ids: FrozenSet[bytes]) -> Dict[bytes, Tuple[bytes, bytes]]:
+    """Worker process: map the FASTA and return wanted records from [start, end)."""
+    entries = {}
+    with open(full_fasta, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        _scan_fasta_range(mm, start, end, protein_ids, entries)
+    return entries
+
+
+def extract_fasta_entries(full_fasta: Path, protein_ids: FrozenSet[bytes]) -> Dict[bytes, Tuple[bytes, bytes]]:
     """
     Extract FASTA entries for specified protein IDs.
 
+    The file is memory-mapped and split into records at newline + '>'
+    boundaries, so no per-line Python work is done. Files of at least
+    PARALLEL_MIN_SIZE bytes are split into chunks scanned by worker
+    processes; files that cannot be mapped are streamed in raw blocks.
+
     Args:
         full_fasta: Path to full FASTA file
         protein_ids: Set of protein IDs to extract
 
     Returns:
-        Dictionary mapping protein ID to (header, sequence)
+        Dictionary mapping protein ID to (header, sequence), all as bytes
     """
     print(f"\nReading full FASTA: {full_fasta}")
 
     entries = {}
-    current_id = None
-    current_header = None
-    current_seq = []
-    found_count = 0
-
-    with open(full_fasta, 'r') as f:
-        for line in f:
-            line = line.rstrip()
-
-            if line.startswith('>'):
-                # Save previous entry
-                if current_id and current_id in protein_ids:
-                    entries[current_id] = (current_header, ''.join(current_seq))
-                    found_count += 1
-
-                # Start new entry
-                current_header = line
-                # Extract protein ID (various formats)
-                # Format: >sp|P12345|NAME_ORGANISM or >P12345 or >tr|P12345|...
-                parts = line[1:].split('|')
-                if len(parts) >= 2:
-                    current_id = parts[1].split()[0]  # Get ID, remove any trailing info
-                else:
-                    current_id = line[1:].split()[0]  # Simple format
-                current_seq = []
-            else:
-                current_seq.append(line)
 
-        # Don't forget last entry
-        if current_id and current_id in protein_ids:
-            entries[current_id] = (current_header, ''.join(current_seq))
-            found_count += 1
+    # CPUs this process may run on (e.g. a SLURM allocation), not the host total
+    if hasattr(os, 'sched_getaffinity'):
+        n_jobs = len(os.sched_getaffinity(0))
+    else:
+        n_jobs = os.cpu_count() or 1
+
+    # Open the input exactly once: closing and reopening a FIFO would leave
+    # its writer without a reader, killing it with SIGPIPE
+    fd = os.open(full_fasta, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        st = os.fstat(fd)
+        # Pipes and FIFOs (e.g. <(zcat proteome.fasta.gz)) report size 0 and
+        # cannot be mapped, so only regular files are memory-mapped
+        is_regular = stat.S_ISREG(st.st_mode)
+        size = st.st_size
+        mm = None
+        if is_regular and size:  # mmap cannot map an empty file
+            try:
+                mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                pass  # e.g. a filesystem without mmap support; stream it instead
+        if mm is None and (size or not is_regular):
+            _scan_fasta_stream(fd, protein_ids, entries)
+    finally:
+        os.close(fd)
+
+    if mm is not None:
+        # The mapping holds its own reference to the file
+        with mm:
+            if size < PARALLEL_MIN_SIZE or n_jobs < 2:
+                if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                _scan_fasta_range(mm, 0, size, protein_ids, entries)
+            else:
+                bounds = _fasta_split_points(mm, n_jobs)
+                print(f"Scanning {len(bounds) - 1} chunks in parallel")
+                with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                    futures = [
+                        pool.submit(_scan_fasta_file_range, full_fasta, start, end, protein_ids)
+                        for start, end in zip(bounds, bounds[1:])
+                    ]
+                    # Merge in file order
+                    for future in futures:
+                        entries.update(future.result())
+
+    found_count = len(entries)
 
     print(f"Found {found_count} / {len(protein_ids)} proteins in FASTA")
 
@@ -154,34 +332,56 @@ def extract_fasta_entries(full_fasta: Path, protein_ids: Set[str]) -> Dict[str,
         missing = protein_ids - set(entries.keys())
         print(f"\nWARNING: {len(missing)} proteins not found in FASTA")
         if len(missing) <= 10:
-            print("Missing IDs:", ', '.join(sorted(missing)))
+            print("Missing IDs:", ', '.join(sorted(pid.decode() for pid in missing)))
 
     return entries
 
 
-def write_minimal_fasta(entries: Dict[str, Tuple[str, str]], output_file: Path):
+def _format_fasta_record(header: bytes, sequence: bytes, width: int = 60) -> bytes:
+    """
+    Render a FASTA record with the sequence wrapped at width residues per line.
+
+    All lines are joined in a single allocation; the trailing empty element
+    supplies the final newline without another concatenation.
+    """
+    lines = [header]
+    lines += [sequence[i:i + width] for i in range(0, len(sequence), width)]
+    lines.append(b'')
+    return b'\n'.join(lines)
+
+
+def write_minimal_fasta(entries: Dict[bytes, Tuple[bytes, bytes]], output_file: Path):
     """Write minimal FASTA file."""
     output_file.parent.mkdir(parents=True, exist_ok=True)
 
     print(f"\nWriting minimal FASTA: {output_file}")
 
-    with open(output_file, 'w') as f:
-        for protein_id in sorted(entries.keys()):
-            header, sequence = entries[protein_id]
-            f.write(f"{header}\n")
-            # Write sequence in 60-character lines
-            for i in range(0, len(sequence), 60):
-                f.write(f"{sequence[i:i+60]}\n")
+    # Each protein is rendered as one bytes block and written in batches
+    with open(output_file, 'wb', buffering=1 << 20) as f:
+        chunks = []
+        bytes_written = 0
+        total_aa = 0
+        # Entries are in full FASTA order, which is already deterministic
+        for header, sequence in entries.values():
+            total_aa += len(sequence)
+            record = _format_fasta_record(header, sequence)
+            bytes_written += len(record)
+            chunks.append(record)
+            if len(chunks) >= WRITE_BATCH_SIZE:
+                f.writelines(chunks)
+                chunks.clear()
+        f.writelines(chunks)
 
     # Calculate statistics
-    total_aa = sum(len(seq) for _, seq in entries.values())
     avg_length = total_aa / len(entries) if entries else 0
 
     print(f"\nFASTA Statistics:")
     print(f"  Proteins: {len(entries)}")
     print(f"  Total amino acids: {total_aa:,}")
     print(f"  Average protein length: {avg_length:.0f} aa")
-    print(f"  File size: ~{(output_file.stat().st_size / 1024):.1f} KB")
+    # Size comes from the bytes written rather than a stat() after closing,
+    # which can stall on network filesystems
+    print(f"  File size: ~{(bytes_written / 1024):.1f} KB")
 
 
 def main():